@@ -13,17 +13,32 @@ sudo `which python` capture_downstreams.py raw \
 ```
 """
 import argparse
+import asyncio
+import functools
 import logging
 import io
 import os
+import re
+import shutil
+import sys
+import tempfile
 
-import configparser
-import subprocess
-
-from typing import List, NamedTuple, Generator
+from typing import (Awaitable, Callable, Dict, Iterator, List, NamedTuple,
+                    Optional, Tuple)
 
 LOG = logging.getLogger(__name__)
 
+# Resolved once, None when not installed
+DVBV5_ZAP_BIN = shutil.which('dvbv5-zap')
+TSHARK_BIN = shutil.which('tshark')
+
+# PIDs are 13 bits
+PID_COUNT = 1 << 13
+
+# Channels in a row that have to fail on an adapter before it is not used
+# anymore. A single failure is more likely a channel without lock.
+MAX_ADAPTER_FAILURES = 3
+
 
 class Channel(NamedTuple):
     """
@@ -39,16 +54,68 @@ class Channel(NamedTuple):
     inversion: str
 
 
-def read_channels(channels: io.StringIO) -> Generator[Channel, None, None]:
+class FastChannelParser:
+    """
+    Parser for dvbv5 channel files. These only use `[NAME]` sections and
+    `KEY = value` lines, so two regular expressions do the work that
+    configparser does in a lot more time.
+    """
+    SECTION_RE = re.compile(r'^\[(.+?)\][ \t]*$', re.M)
+    KV_RE = re.compile(r'^[ \t]*(\w+)[ \t]*=[ \t]*(.*?)[ \t]*$', re.M)
+
+    def parse(self, text: str) -> Dict[str, Dict[str, str]]:
+        """
+        Return the properties of each section in *text*, by section name.
+        Keys are upper case, like in the files dvbv5 writes, whatever case
+        they have in *text*.
+        """
+        sections: Dict[str, Dict[str, str]] = {}
+        # split() alternates between section names and section bodies, after
+        # whatever precedes the first section
+        parts = self.SECTION_RE.split(text)
+        for name, body in zip(parts[1::2], parts[2::2]):
+            if name in sections:
+                raise ValueError(f"Channel [{name}] occurs more than once")
+            sections[name] = {key.upper(): value
+                              for key, value in self.KV_RE.findall(body)}
+        return sections
+
+
+# Parsed channel files by (path, mtime)
+_PARSED_CHANNELS: Dict[Tuple[str, int], Dict[str, Dict[str, str]]] = {}
+
+
+def parse_channels(channels: io.StringIO) -> Dict[str, Dict[str, str]]:
     """
-    Read all the properties of the channels in the file, even though it is
-    likely that only name will be used.
+    Parse a channel file, re-using the result of an earlier call for the same
+    unchanged file.
     """
-    config = configparser.ConfigParser()
-    config.read_file(channels)
+    try:
+        key = (channels.name, os.stat(channels.name).st_mtime_ns)
+    except (AttributeError, OSError):
+        # Not backed by a file on disk, can not tell whether it changed
+        return FastChannelParser().parse(channels.read())
+
+    if key not in _PARSED_CHANNELS:
+        _PARSED_CHANNELS[key] = FastChannelParser().parse(channels.read())
+    return _PARSED_CHANNELS[key]
 
-    for name in config.sections():
-        channel = config[name]
+
+def read_channel_names_and_freqs(channels: io.StringIO
+                                 ) -> Iterator[Tuple[str, int]]:
+    """
+    Read only the name and frequency (in Hertz) of the channels in the file,
+    which is all that is needed to record them.
+    """
+    for name, channel in parse_channels(channels).items():
+        yield name, int(channel['FREQUENCY'])
+
+
+def read_channels_full(channels: io.StringIO) -> Iterator[Channel]:
+    """
+    Read all the properties of the channels in the file
+    """
+    for name, channel in parse_channels(channels).items():
         yield Channel(
             name=name,
             delivery_system=channel['DELIVERY_SYSTEM'].lower(),
@@ -59,7 +126,21 @@ def read_channels(channels: io.StringIO) -> Generator[Channel, None, None]:
             inversion=channel['INVERSION']
         )
 
-    return None
+
+@functools.lru_cache(maxsize=None)
+def _pid_term(p: int) -> str:
+    """
+    Return the filter term matching pid *p*
+    """
+    return f"(mp2t.pid == 0x{p:02x})"
+
+
+@functools.lru_cache(maxsize=None)
+def _pid_filter(pids: Tuple[int, ...]) -> str:
+    """
+    Return the disjunction of the filter terms for *pids*
+    """
+    return " || ".join(map(_pid_term, pids))
 
 
 def pid_filter(pids: List[int]) -> str:
@@ -67,76 +148,266 @@ def pid_filter(pids: List[int]) -> str:
     Return a disjunctive filter string to be used in wireshark/tshark that only
     accepts pids in *pids* (if provided)
     """
-    return " || ".join([f"(mp2t.pid == 0x{p:02x})" for p in pids])
+    # The order of the terms does not matter, sort them so every ordering of
+    # the same pids shares a cache entry
+    return _pid_filter(tuple(sorted(pids)))
+
+
+def _require(binary: Optional[str], name: str) -> None:
+    """
+    Fail before recording anything when *name* was not found
+    """
+    if binary is None:
+        raise RuntimeError(f"{name} not found in PATH")
+
+
+def _capture_prefix(config_file: str, duration: int,
+                    adapter: Optional[int] = None) -> List[str]:
+    """
+    The part of the dvbv5-zap command line that is the same for every channel
+    recorded on *adapter* (the default adapter if not set)
+    """
+    capture_prefix = [DVBV5_ZAP_BIN,
+                      '-c', config_file,
+                      '-P',
+                      '-t', str(duration)]
+    if adapter is not None:
+        capture_prefix += ['-a', str(adapter)]
+    return capture_prefix
+
+
+async def _record_on_adapters(
+        channel_config: io.StringIO,
+        config_file: str,
+        duration: int,
+        adapters: List[int],
+        record: Callable[[List[str], str, int], Awaitable[int]]
+        ) -> List[str]:
+    """
+    Call *record* with the dvbv5-zap prefix, name and frequency of every
+    channel. Each adapter records one channel at a time, and all adapters
+    work in parallel. Returns the names of the channels that could not be
+    recorded.
+
+    *record* returns the exit code of dvbv5-zap. A channel that fails is
+    skipped. An adapter on which MAX_ADAPTER_FAILURES channels in a row fail
+    is not used anymore, and the channels that failed on it get one more try
+    on the other adapters.
+    """
+    channels = tuple(read_channel_names_and_freqs(channel_config))
+    LOG.info("Processing %d channels", len(channels))
+
+    # (number, name, frequency, whether this is a retry)
+    queue: asyncio.Queue = asyncio.Queue()
+    for number, (name, frequency) in enumerate(channels, 1):
+        queue.put_nowait((number, name, frequency, False))
+    # (adapter, queue entry) of the failed recordings
+    failed: List[Tuple[Optional[int], Tuple[int, str, int, bool]]] = []
+
+    async def worker(adapter: Optional[int]) -> bool:
+        """
+        Record channels until the queue is empty, return False if *adapter*
+        failed too often
+        """
+        capture_prefix = _capture_prefix(config_file, duration, adapter)
+        adapter_name = 'default' if adapter is None else adapter
+        failures = 0
+        while not queue.empty():
+            entry = queue.get_nowait()
+            number, name, frequency, _ = entry
+            LOG.info("Recording %s (%d/%d)", name, number, len(channels))
+            returncode = await record(capture_prefix, name, frequency)
+            if returncode == 0:
+                failures = 0
+                continue
+
+            LOG.error("dvbv5-zap failed for %s on adapter %s (exit code %d), "
+                      "skipping it", name, adapter_name, returncode)
+            failed.append((adapter, entry))
+            failures += 1
+            if failures >= MAX_ADAPTER_FAILURES:
+                LOG.error("%d channels in a row failed on adapter %s, not "
+                          "using it anymore", failures, adapter_name)
+                return False
+        return True
+
+    working = adapters or [None]
+    while working and not queue.empty():
+        results = await asyncio.gather(*(worker(adapter)
+                                         for adapter in working))
+        working = [adapter for adapter, ok in zip(working, results) if ok]
+        if not working:
+            break
+        # The channels that failed on an adapter that is not used anymore
+        # may well work on another one, try those once more
+        for adapter, entry in list(failed):
+            number, name, frequency, retried = entry
+            if adapter not in working and not retried:
+                failed.remove((adapter, entry))
+                queue.put_nowait((number, name, frequency, True))
+
+    skipped = sorted([entry for _, entry in failed] +
+                     [queue.get_nowait() for _ in range(queue.qsize())])
+    if skipped:
+        LOG.error("%d of %d channels were not recorded: %s", len(skipped),
+                  len(channels), ", ".join(entry[1] for entry in skipped))
+    return [entry[1] for entry in skipped]
+
+
+def _log_cmd(cmd: List[str]) -> None:
+    """
+    Log a command line, without building it if it would not be shown
+    """
+    if LOG.isEnabledFor(logging.INFO):
+        LOG.info(" ".join(cmd))
 
 
-def dvb_record_raw_channels(channel_config: io.StringIO,
-                            config_file: str,
-                            verbose: bool = False,
-                            prefix: str = 'Capture',
-                            path: str = '.',
-                            duration: int = 45) -> None:
+async def _capture_one(capture_prefix: List[str], channel_name: str,
+                       output_file_name: str) -> int:
     """
-    Capture raw mpeg ts
+    Record channel *channel_name* into *output_file_name*, return the exit
+    code of dvbv5-zap
     """
-    for channel in read_channels(channel_config):
-        freq_mhz = channel.frequency // 10**6
-        output_file_name = f"{path}/{prefix}_{channel.name}_{freq_mhz}.ts"
+    capture_cmd = capture_prefix + [channel_name, '-o', output_file_name]
+    _log_cmd(capture_cmd)
+    zap = await asyncio.create_subprocess_exec(*capture_cmd)
+    return await zap.wait()
 
-        capture_cmd = ['/usr/bin/dvbv5-zap',
-                       '-c', config_file,
-                       '-P',
-                       '-t', str(duration),
-                       channel.name,
-                       '-o', output_file_name]
-        LOG.info(" ".join(capture_cmd))
-        subprocess.call(capture_cmd)
+
+async def _filter_one(filter_args: List[str], capture_path: str,
+                      output_file_name: str,
+                      slots: asyncio.Semaphore) -> None:
+    """
+    Filter the capture in *capture_path* into *output_file_name* using tshark
+    once one of the *slots* is free, and remove the capture afterwards
+    """
+    # No name resolution, it is not needed to match on pids
+    filter_cmd = [TSHARK_BIN, '-n', '-r', capture_path] + \
+        filter_args + ['-w', output_file_name]
+    try:
+        async with slots:
+            _log_cmd(filter_cmd)
+            tshark = await asyncio.create_subprocess_exec(*filter_cmd)
+            await tshark.wait()
+    finally:
+        os.remove(capture_path)
 
 
-def dvb_record_filtered_channels(channel_config: io.StringIO,
-                                 config_file: str,
-                                 verbose: bool = False,
-                                 prefix: str = 'Capture',
-                                 path: str = '.',
-                                 duration: int = 45,
-                                 skip_pids: List[int] = [],
-                                 pids: List[int] = []) -> None:
+async def dvb_record_raw_channels(channel_config: io.StringIO,
+                                  config_file: str,
+                                  verbose: bool = False,
+                                  prefix: str = 'Capture',
+                                  path: str = '.',
+                                  duration: int = 45,
+                                  adapters: List[int] = []) -> List[str]:
     """
-    Capture data and filter it by pid, save as pcapng
+    Capture raw mpeg ts, return the names of the channels that failed
     """
+    _require(DVBV5_ZAP_BIN, 'dvbv5-zap')
+
+    async def record(capture_prefix: List[str], name: str,
+                     frequency: int) -> int:
+        freq_mhz = frequency // 10**6
+        output_file_name = f"{path}/{prefix}_{name}_{freq_mhz}.ts"
+
+        returncode = await _capture_one(capture_prefix, name,
+                                        output_file_name)
+        if returncode != 0 and os.path.exists(output_file_name):
+            os.remove(output_file_name)
+        return returncode
+
+    return await _record_on_adapters(channel_config, config_file, duration,
+                                     adapters, record)
+
+
+async def dvb_record_filtered_channels(channel_config: io.StringIO,
+                                       config_file: str,
+                                       verbose: bool = False,
+                                       prefix: str = 'Capture',
+                                       path: str = '.',
+                                       duration: int = 45,
+                                       skip_pids: List[int] = [],
+                                       pids: List[int] = [],
+                                       adapters: List[int] = []
+                                       ) -> List[str]:
+    """
+    Capture data and filter it by pid, save as pcapng. Return the names of
+    the channels that failed.
+    """
+    _require(DVBV5_ZAP_BIN, 'dvbv5-zap')
+    _require(TSHARK_BIN, 'tshark')
+
     filter_str = ""
     if skip_pids and pids:
         print("--skip_pid and --pid were both used at the same time, this is "
               "not possible, aborting")
-        return
+        return []
     elif skip_pids:
         filter_str = f"!({pid_filter(skip_pids)})"
-    else:
+    elif pids:
         filter_str = f"({pid_filter(pids)})"
 
-    for channel in read_channels(channel_config):
-        freq_mhz = channel.frequency // 10**6
-        output_file_name = f"{path}/{prefix}_{channel.name}_{freq_mhz}.pcapng"
+    # Read filter, without a filter tshark only has to copy the packets
+    filter_args = ['-R', filter_str, '-2'] if filter_str else []
+
+    # Captures on an adapter have to run one after the other, but tshark can
+    # filter the previous channel while the next one is recorded. Bound the
+    # number of tshark processes that run at the same time.
+    slots = asyncio.Semaphore(os.cpu_count() or 1)
+    filters = []
+    # tshark's MPEG-TS reader seeks back after scanning ahead for the bitrate,
+    # so it can not read from a pipe: captures go to a file first. They live
+    # in a private directory that is removed even when a recording fails.
+    capture_dir = tempfile.TemporaryDirectory(dir=path)
+
+    async def record(capture_prefix: List[str], name: str,
+                     frequency: int) -> int:
+        freq_mhz = frequency // 10**6
+        output_file_name = f"{path}/{prefix}_{name}_{freq_mhz}.pcapng"
+        capture_path = f"{capture_dir.name}/{name}.ts"
 
-        capture_cmd = ['/usr/bin/dvbv5-zap',
-                       '-c', config_file,
-                       '-P',
-                       '-t', str(duration),
-                       channel.name,
-                       '-o', 'tmp.ts']
-        LOG.info(" ".join(capture_cmd))
-        subprocess.call(capture_cmd)
+        returncode = await _capture_one(capture_prefix, name, capture_path)
+        if returncode != 0:
+            if os.path.exists(capture_path):
+                os.remove(capture_path)
+            return returncode
 
-        # Filter file using tshark
-        filter_cmd = ['/usr/bin/tshark',
-                      '-r', 'tmp.ts',
-                      '-R', filter_str, '-2', # read filter
-                      '-w', output_file_name]
-        LOG.info(" ".join(filter_cmd))
+        filters.append(asyncio.create_task(
+            _filter_one(filter_args, capture_path, output_file_name, slots)))
+        return returncode
 
-        subprocess.call(filter_cmd)
-        # Remove the temporary file
-        os.remove('tmp.ts')
+    try:
+        skipped = await _record_on_adapters(channel_config, config_file,
+                                            duration, adapters, record)
+        await asyncio.gather(*filters)
+        return skipped
+    finally:
+        capture_dir.cleanup()
+
+
+def adapter_list(value: str) -> List[int]:
+    """
+    Parse a comma separated list of distinct, non-negative adapter numbers
+    """
+    result = [int(adapter) for adapter in value.split(',')]
+    if any(adapter < 0 for adapter in result):
+        raise argparse.ArgumentTypeError(
+            f"adapter numbers in {value} must not be negative")
+    if len(set(result)) != len(result):
+        raise argparse.ArgumentTypeError(
+            f"adapter numbers in {value} must not repeat")
+    return result
+
+
+def pid(value: str) -> int:
+    """
+    Parse a pid, which has to fit in the 13 bits of the TS header
+    """
+    result = int(value)
+    if not 0 <= result < PID_COUNT:
+        raise argparse.ArgumentTypeError(
+            f"pid {value} is not in the range 0-{PID_COUNT - 1}")
+    return result
 
 
 if __name__ == '__main__':
@@ -152,9 +423,9 @@ if __name__ == '__main__':
     filtered = subs.add_parser('filtered', help='Save a filtered .pcap file')
     filtered.set_defaults(func=dvb_record_filtered_channels)
 
-    filtered.add_argument('--pid', dest='pids', type=int, action='append',
+    filtered.add_argument('--pid', dest='pids', type=pid, action='append',
                           help='pid(s) to keep, default=all')
-    filtered.add_argument('--skip_pid', dest='skip_pids', type=int,
+    filtered.add_argument('--skip_pid', dest='skip_pids', type=pid,
                           action='append', help='pid(s) to skip, '
                           'pid and skip_pid are mutually exclusive')
     # Add the shared options to both sub-parsers
@@ -170,6 +441,9 @@ if __name__ == '__main__':
                        help='Prefix for the file names')
         p.add_argument('--path', type=str, default='.',
                        help='Directory to save files in')
+        p.add_argument('--adapters', type=adapter_list,
+                       help='Comma separated DVB adapters to record on in '
+                       'parallel, e.g. 0,1,2. Default: the default adapter')
 
     args = parser.parse_args()
 
@@ -180,8 +454,10 @@ if __name__ == '__main__':
         logging.getLogger().setLevel(logging.INFO)
 
     if args and hasattr(args, 'func'):
-        args.func(config_file=args.channel_config.name,
-                  **{k: v for k, v in args.__dict__.items()
-                     if v and k != 'func'})
+        skipped = asyncio.run(args.func(
+            config_file=args.channel_config.name,
+            **{k: v for k, v in args.__dict__.items() if v and k != 'func'}))
+        if skipped:
+            sys.exit(1)
     else:
         parser.print_help()